@@ -1,11 +1,20 @@
 import os
+import gzip
+import queue
 import sqlite3
 import json
 import time
-import random
+import secrets
 import string
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import lru_cache
 from datetime import datetime, timedelta, timezone
-from flask import Flask, request, session, redirect, url_for, render_template_string, jsonify, flash
+from flask import Flask, request, session, redirect, url_for, render_template, jsonify, flash
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import generate_etag
 from werkzeug.security import check_password_hash
 
 ADMIN_USER_HASH = 'scrypt:32768:8:1$DY3lShSP5RscCd7a$35f5f3184cb15c2a542089f0e10470a1fa5b00e5701a5dff5ef7871a58a2cdc2094c22cf4d6b5f1fff890a888163ea5b174dcd0b5c2ccf4830dc0162c01893e1'
@@ -15,152 +24,559 @@ ADMIN_KEY_HASH = 'scrypt:32768:8:1$iFL8asFNsnds2YlG$e61de66465528811d8059f61a1a6
 # Try importing psycopg2 for Vercel Postgres; pass if not found (local use)
 try:
     import psycopg2
-    from psycopg2.extras import RealDictCursor
+    from psycopg2.extras import RealDictCursor, execute_values
 except ImportError:
     psycopg2 = None
 
+# orjson encodes JSON in C; fall back to Flask's stdlib encoder when it is missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Configuration
+SECRET_KEY_FILE = '.secret_key'
+
+def load_secret_key():
+    """SECRET_KEY env var, else a key persisted in SECRET_KEY_FILE so sessions survive restarts."""
+    if os.environ.get('SECRET_KEY'): return os.environ['SECRET_KEY']
+    try:
+        with open(SECRET_KEY_FILE, 'rb') as f: return f.read()
+    except FileNotFoundError:
+        pass
+    key = os.urandom(24)
+    try:
+        # Written owner-only (mkstemp uses 0600) to a temp name, then linked into place: the link is atomic
+        # and fails if the file exists, so no worker can ever read a half-written key
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(SECRET_KEY_FILE)))
+        try:
+            with os.fdopen(fd, 'wb') as f: f.write(key)
+            os.link(tmp, SECRET_KEY_FILE)
+        finally:
+            os.unlink(tmp)
+    except FileExistsError:
+        # Another worker created it first; use theirs so both sign cookies alike
+        with open(SECRET_KEY_FILE, 'rb') as f: return f.read() or key
+    except OSError:
+        pass  # Read-only filesystem (e.g. Vercel): per-process key, set SECRET_KEY there
+    return key
+
 app = Flask(__name__)
-app.secret_key = os.environ.get('SECRET_KEY', os.urandom(24))
+app.secret_key = load_secret_key()
 app.permanent_session_lifetime = timedelta(hours=1)
 DB_FILE = 'anonchat.db'
 
+class ORJSONProvider(DefaultJSONProvider):
+    """Serializes jsonify() responses with orjson; types it cannot handle go through Flask's default."""
+    def dumps(self, obj, **kwargs):
+        return self.dumps_bytes(obj).decode()
+
+    def dumps_bytes(self, obj):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z)
+
+    def loads(self, s, **kwargs):
+        # The session serializer passes object_hook to untag values; only the stdlib honours it
+        if kwargs: return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+if orjson: app.json = ORJSONProvider(app)
+
 # --- Security / Rate Limiting (In-Memory) ---
-RATE_LIMITS = {}
+# ident -> {action: (tokens, last)}, least recently seen first; capped so rotating IPs cannot grow it forever.
+# Split into shards by ident hash, each with its own lock, so concurrent requests rarely wait on each other.
+RATE_LIMIT_SHARDS = 16
+RATE_LIMITS = [(OrderedDict(), threading.Lock()) for _ in range(RATE_LIMIT_SHARDS)]
+MAX_TRACKED = 100_000  # across all shards
 
 def check_rate_limit(ident, action, limit, window):
-    """Returns True if allowed, False if limit exceeded."""
-    now = time.time()
-    if ident not in RATE_LIMITS: RATE_LIMITS[ident] = {}
-    if action not in RATE_LIMITS[ident]: RATE_LIMITS[ident][action] = []
-    
-    timestamps = [t for t in RATE_LIMITS[ident][action] if now - t < window]
-    RATE_LIMITS[ident][action] = timestamps
-    
-    if len(timestamps) >= limit: return False
-    RATE_LIMITS[ident][action].append(now)
-    return True
+    """
+    Token bucket: up to `limit` tokens, refilled at limit/window per second.
+    Returns True if allowed, False if limit exceeded.
+    """
+    limits, lock = RATE_LIMITS[hash(ident) % RATE_LIMIT_SHARDS]
+    # The shard lock covers the read-modify-write, so concurrent requests cannot spend the same token
+    with lock:
+        now = time.monotonic()
+        # Pop and re-insert to mark the ident as most recently used
+        buckets = limits.pop(ident, None)
+        if buckets is None:
+            buckets = {}
+            while len(limits) >= MAX_TRACKED // RATE_LIMIT_SHARDS: limits.popitem(last=False)
+        limits[ident] = buckets
+
+        tokens, last = buckets.get(action, (limit, now))
+        tokens = min(limit, tokens + (now - last) * limit / window)
+
+        if tokens < 1:
+            buckets[action] = (tokens, now)
+            return False
+        buckets[action] = (tokens - 1, now)
+        return True
+
+RATE_LIMIT_IDLE = 600  # longer than any window, so a dropped ident's buckets would have refilled anyway
+
+def sweep_rate_limits():
+    """Drops idents idle for RATE_LIMIT_IDLE seconds. Shards are LRU-ordered, so each stops at its first live ident."""
+    cutoff = time.monotonic() - RATE_LIMIT_IDLE
+    for limits, lock in RATE_LIMITS:
+        with lock:
+            while limits:
+                buckets = next(iter(limits.values()))
+                if max((last for _, last in buckets.values()), default=0) >= cutoff: break
+                limits.popitem(last=False)
+
+# --- SQL Statements (hot path) ---
+# Kept as module constants so every call passes the identical string and hits SQLite's statement cache
+# timestamp is left to the column default so the database clock stamps every row
+SQL_INSERT_MESSAGES_SQLITE = "INSERT INTO messages (username, content, room_code) VALUES (?, ?, ?)"
+SQL_INSERT_MESSAGES_PG = "INSERT INTO messages (username, content, room_code) VALUES %s"
+# Newest MESSAGE_LIMIT rows only, walked backwards on the primary key; callers flip them to oldest-first
+MESSAGE_LIMIT = 50
+MAX_MESSAGE_LENGTH = 2000
+MAX_MESSAGE_ID = 2**63 - 1
+SQL_SELECT_ROOM_MESSAGES = f"SELECT id, username, content, timestamp FROM messages WHERE room_code = ? ORDER BY id DESC LIMIT {MESSAGE_LIMIT}"
+SQL_SELECT_GLOBAL_MESSAGES = f"SELECT id, username, content, timestamp FROM messages WHERE room_code IS NULL ORDER BY id DESC LIMIT {MESSAGE_LIMIT}"
+# Deltas for clients that already hold everything up to a given id
+SQL_SELECT_ROOM_MESSAGES_SINCE = f"SELECT id, username, content, timestamp FROM messages WHERE room_code = ? AND id > ? ORDER BY id ASC LIMIT {MESSAGE_LIMIT}"
+SQL_SELECT_GLOBAL_MESSAGES_SINCE = f"SELECT id, username, content, timestamp FROM messages WHERE room_code IS NULL AND id > ? ORDER BY id ASC LIMIT {MESSAGE_LIMIT}"
 
 # --- Database Wrapper (SQLite + Postgres) ---
+PG_MAX_CONN = 10
+# Caps open connections; callers wait for a free slot instead of failing when all are busy
+PG_SLOTS = threading.BoundedSemaphore(PG_MAX_CONN)
+# Idle connections kept for reuse, up to PG_MAX_CONN, so concurrent requests skip the connect/TLS/auth handshake
+PG_IDLE = queue.LifoQueue(maxsize=PG_MAX_CONN)
+PG_IDLE_CHECK = 30   # seconds; connections idle longer are pinged before reuse (hosted Postgres drops idle sockets)
+PG_LAST_USED = {}    # id(conn) -> monotonic time it was opened or went back to the pool; dropped on close
+# Idle SQLite connections shared by all request threads; the dev server starts a thread per request,
+# so per-thread connections would be reopened (and their page/statement caches lost) on every hit
+SQLITE_POOL_SIZE = 8
+SQLITE_POOL = queue.LifoQueue(maxsize=SQLITE_POOL_SIZE)  # LIFO hands out the most recently used, warmest connection
+
+def open_pg_connection():
+    conn = psycopg2.connect(os.environ['POSTGRES_URL'])
+    PG_LAST_USED[id(conn)] = time.monotonic()  # just connected, so no ping needed on first use
+    return conn
+
+def discard_pg_connection(conn):
+    PG_LAST_USED.pop(id(conn), None)
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+def close_pg_pool():
+    """Closes every idle connection, e.g. before a server forks workers that must not share the sockets."""
+    while True:
+        try:
+            discard_pg_connection(PG_IDLE.get_nowait())
+        except queue.Empty:
+            return
+
+def get_pg_connection():
+    """Checks out a live connection: the most recently used idle one, else a new one. Waits while all are busy."""
+    PG_SLOTS.acquire()
+    try:
+        while True:
+            try:
+                conn = PG_IDLE.get_nowait()
+            except queue.Empty:
+                return open_pg_connection()
+            if not conn.closed:
+                if time.monotonic() - PG_LAST_USED.get(id(conn), 0) < PG_IDLE_CHECK: return conn
+                try:
+                    with conn.cursor() as cur: cur.execute("SELECT 1")
+                    conn.rollback()
+                    return conn
+                except psycopg2.Error:
+                    pass
+            # Dropped by the server while idle: discard it and try the next one
+            discard_pg_connection(conn)
+    except BaseException:
+        PG_SLOTS.release()
+        raise
+
 def get_db_connection():
     if os.environ.get('POSTGRES_URL'):
         if not psycopg2: raise ImportError("psycopg2 is required for Vercel")
-        conn = psycopg2.connect(os.environ['POSTGRES_URL'])
-        return conn, 'postgres'
+        return get_pg_connection(), 'postgres'
     else:
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
-        return conn, 'sqlite'
+        try:
+            return SQLITE_POOL.get_nowait(), 'sqlite'
+        except queue.Empty:
+            return open_sqlite_connection(), 'sqlite'
 
-def execute_query(query, args=(), fetch_one=False, fetch_all=False):
+def open_sqlite_connection():
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=67108864")
+    conn.execute("PRAGMA cache_size=-20000")
+    return conn
+
+def release_db_connection(conn, db_type):
+    """Returns a connection for reuse. SQLite keeps up to SQLITE_POOL_SIZE idle (extras from a burst are closed), Postgres PG_MAX_CONN."""
+    if db_type == 'sqlite':
+        if conn.in_transaction: conn.rollback()  # never pool a connection holding locks
+        try:
+            SQLITE_POOL.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+    else:
+        try:
+            if conn.closed:
+                discard_pg_connection(conn)
+            else:
+                PG_LAST_USED[id(conn)] = time.monotonic()
+                PG_IDLE.put_nowait(conn)  # never full: slots cap open connections at PG_MAX_CONN
+        finally:
+            PG_SLOTS.release()
+
+def rollback_quietly(conn):
+    """Rolls back after a failed statement; a connection the server already dropped has nothing to roll back."""
+    if getattr(conn, 'closed', 0): return
+    try:
+        conn.rollback()
+    except Exception as e:
+        print(f"Rollback Error: {e}")
+
+@contextmanager
+def db_connection():
+    """Yields (conn, db_type) and always hands the connection back, even if the block raises."""
     conn, db_type = get_db_connection()
-    result = None
     try:
-        if db_type == 'postgres':
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            query = query.replace('?', '%s')
-        else:
-            cur = conn.cursor()
+        yield conn, db_type
+    finally:
+        release_db_connection(conn, db_type)
 
-        cur.execute(query, args)
-        
-        if fetch_one:
-            res = cur.fetchone()
-            result = dict(res) if res else None
-        elif fetch_all:
-            res = cur.fetchall()
-            result = [dict(row) for row in res]
-        else:
+@lru_cache(maxsize=128)
+def pg_query(query):
+    """Rewrites SQLite-style ? placeholders to psycopg2's %s, once per distinct statement."""
+    return query.replace('?', '%s')
+
+def execute_query(query, args=(), fetch_one=False, fetch_all=False):
+    result = None
+    with db_connection() as (conn, db_type):
+        try:
+            if db_type == 'postgres':
+                cur = conn.cursor(cursor_factory=RealDictCursor)
+                query = pg_query(query)
+            else:
+                cur = conn.cursor()
+
+            cur.execute(query, args)
+
+            # RealDictCursor rows already are dicts; only sqlite3.Row needs converting
+            if fetch_one:
+                res = cur.fetchone()
+                result = (res if db_type == 'postgres' else dict(res)) if res else None
+            elif fetch_all:
+                res = cur.fetchall()
+                result = res if db_type == 'postgres' else [dict(row) for row in res]
+            else:
+                result = cur.rowcount
+            # Commit reads as well so a pooled connection is never handed back mid-transaction
             conn.commit()
-    except Exception as e:
-        print(f"Database Error: {e}")
-        if not fetch_one and not fetch_all:
-            conn.rollback()
-    finally:
-        conn.close()
+        except Exception as e:
+            print(f"Database Error: {e}")
+            rollback_quietly(conn)
+            result = None
     return result
 
+SCHEMA_LOCK_ID = 4242
+
 def init_db():
-    conn, db_type = get_db_connection()
+    # Deployments whose schema is already in place can skip the DDL round-trips on every cold start
+    if os.environ.get('SCHEMA_INITIALIZED'): return
+    with db_connection() as (conn, db_type):
+        try:
+            cur = conn.cursor()
+            # Serialize concurrent cold starts; CREATE ... IF NOT EXISTS can still race on Postgres
+            if db_type == 'postgres': cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+            pk_type = "SERIAL PRIMARY KEY" if db_type == 'postgres' else "INTEGER PRIMARY KEY AUTOINCREMENT"
+            ts_type = "TIMESTAMP" if db_type == 'postgres' else "DATETIME"
+
+            # Table: Rooms
+            cur.execute(f'''
+                CREATE TABLE IF NOT EXISTS rooms (
+                    code TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    created_at {ts_type} DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Table: Messages
+            cur.execute(f'''
+                CREATE TABLE IF NOT EXISTS messages (
+                    id {pk_type},
+                    username TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    room_code TEXT,
+                    timestamp {ts_type} DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Index: lets the hourly expiry delete a range instead of scanning the table
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(timestamp)")
+            # Index: room reads filter on room_code and walk id, so this serves both the filter and the order
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_room ON messages(room_code, id)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_rooms_created ON rooms(created_at)")
+
+            # Table: Active Users (For unique usernames)
+            cur.execute(f'''
+                CREATE TABLE IF NOT EXISTS active_users (
+                    username TEXT PRIMARY KEY,
+                    last_seen {ts_type} DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Index: the active-node count and presence expiry only touch recently seen rows
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_active_users_seen ON active_users(last_seen)")
+
+            conn.commit()
+        except Exception as e:
+            print(f"DB Init Error: {e}")
+            rollback_quietly(conn)
+
+def sql_ago(seconds):
+    """SQL expression for 'now minus N seconds', evaluated by the database in its own dialect."""
+    if os.environ.get('POSTGRES_URL'): return f"NOW() - INTERVAL '{int(seconds)} seconds'"
+    return f"datetime('now', '-{int(seconds)} seconds')"
+
+CLEANUP_BATCH = 1000
+
+def cleanup_data():
+    """
+    1. Delete messages older than 1 hour, CLEANUP_BATCH rows per transaction.
+    2. Delete expired rooms and inactive users (inactive > 2 mins) to free up usernames.
+    """
+    with db_connection() as (conn, db_type):
+        try:
+            cur = conn.cursor()
+            # Commit each batch so a backlog of expired rows never holds the write lock for long
+            expired = 0
+            while True:
+                cur.execute(f"DELETE FROM messages WHERE id IN "
+                            f"(SELECT id FROM messages WHERE timestamp < {sql_ago(3600)} LIMIT {CLEANUP_BATCH})")
+                conn.commit()
+                expired += cur.rowcount
+                if cur.rowcount < CLEANUP_BATCH: break
+            cur.execute(f"DELETE FROM rooms WHERE created_at < {sql_ago(3600)}")
+            cur.execute(f"DELETE FROM active_users WHERE last_seen < {sql_ago(120)}")
+            conn.commit()
+            # Refreshes planner statistics only for tables whose shape changed; cheap when nothing did
+            if db_type == 'sqlite': cur.execute("PRAGMA optimize")
+            if expired > 0: all_rooms_changed()
+        except Exception as e:
+            print(f"Cleanup Error: {e}")
+            rollback_quietly(conn)
+
+CLEANUP_INTERVAL = 60
+LAST_CLEANUP = -CLEANUP_INTERVAL  # monotonic clock; first request always cleans up
+CLEANUP_LOCK = threading.Lock()
+
+def run_cleanup():
     try:
-        cur = conn.cursor()
-        pk_type = "SERIAL PRIMARY KEY" if db_type == 'postgres' else "INTEGER PRIMARY KEY AUTOINCREMENT"
-        ts_type = "TIMESTAMP" if db_type == 'postgres' else "DATETIME"
-        
-        # Table: Rooms
-        cur.execute(f'''
-            CREATE TABLE IF NOT EXISTS rooms (
-                code TEXT PRIMARY KEY,
-                name TEXT NOT NULL,
-                created_at {ts_type} DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Table: Messages
-        cur.execute(f'''
-            CREATE TABLE IF NOT EXISTS messages (
-                id {pk_type},
-                username TEXT NOT NULL,
-                content TEXT NOT NULL,
-                room_code TEXT,
-                timestamp {ts_type} DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Table: Active Users (For unique usernames)
-        cur.execute(f'''
-            CREATE TABLE IF NOT EXISTS active_users (
-                username TEXT PRIMARY KEY,
-                last_seen {ts_type} DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
-    except Exception as e:
-        print(f"DB Init Error: {e}")
+        cleanup_data()
+        sweep_rate_limits()
     finally:
-        conn.close()
+        CLEANUP_LOCK.release()
 
-def cleanup_data():
+def maybe_cleanup_data():
     """
-    1. Delete messages older than 1 hour.
-    2. Delete inactive users (inactive > 2 mins) to free up usernames.
+    Starts cleanup_data() on a background thread at most once per CLEANUP_INTERVAL seconds,
+    so no request waits on the deletes. Never runs two cleanups at once.
     """
-    one_hour_ago = datetime.now(timezone.utc) - timedelta(hours=1)
-    two_mins_ago = datetime.now(timezone.utc) - timedelta(minutes=2)
-    
-    execute_query("DELETE FROM messages WHERE timestamp < ?", (one_hour_ago,))
-    execute_query("DELETE FROM rooms WHERE created_at < ?", (one_hour_ago,))
-    execute_query("DELETE FROM active_users WHERE last_seen < ?", (two_mins_ago,))
+    global LAST_CLEANUP
+    now = time.monotonic()
+    if now - LAST_CLEANUP < CLEANUP_INTERVAL: return
+    if not CLEANUP_LOCK.acquire(blocking=False): return
+    LAST_CLEANUP = now
+    threading.Thread(target=run_cleanup, daemon=True).start()
 
 def update_user_presence(username):
-    """Updates last_seen for a user. If not exists (shouldn't happen if logged in), re-inserts."""
-    now = datetime.now(timezone.utc)
-    # Try update first
-    conn, db_type = get_db_connection()
+    """Refreshes last_seen for a user, re-inserting the row if cleanup removed it, in one statement."""
+    execute_query(
+        "INSERT INTO active_users (username, last_seen) VALUES (?, CURRENT_TIMESTAMP) "
+        "ON CONFLICT (username) DO UPDATE SET last_seen = CURRENT_TIMESTAMP",
+        (username,)
+    )
+
+def touch_user_presence(username):
+    """Refreshes last_seen only; unlike update_user_presence it never resurrects a row /logout deleted."""
+    execute_query("UPDATE active_users SET last_seen = CURRENT_TIMESTAMP WHERE username = ?", (username,))
+
+ACTIVE_COUNT_TTL = 1.0
+ACTIVE_COUNT_CACHE = (-ACTIVE_COUNT_TTL, 0)  # (computed_at, count) on the monotonic clock
+
+def get_active_user_count():
+    """Count users active in last 30 seconds; recomputed at most once per ACTIVE_COUNT_TTL."""
+    global ACTIVE_COUNT_CACHE
+    computed_at, count = ACTIVE_COUNT_CACHE
+    if time.monotonic() - computed_at < ACTIVE_COUNT_TTL: return count
+    res = execute_query(f"SELECT COUNT(*) as count FROM active_users WHERE last_seen > {sql_ago(30)}", fetch_one=True)
+    count = res['count'] if res else 0
+    ACTIVE_COUNT_CACHE = (time.monotonic(), count)
+    return count
+
+# --- Message Response Cache & Change Signals ---
+# room_code -> {since: (cached_at, body, etag, gzipped body or None)}; None is the global room
+MESSAGE_CACHE = {}
+MESSAGE_CACHE_TTL = 1.0
+MESSAGE_CACHE_MAX_KEYS = 64  # per room; keys come from the client's ?since=
+
+# room_code -> Condition woken on every change, plus a change counter so no wakeup is missed.
+# Entries exist only while a stream holds them (ROOM_STREAMS counts holders), so expired rooms leave nothing behind.
+ROOM_SIGNALS = {}
+ROOM_SIGNALS_LOCK = threading.Lock()
+ROOM_SEQ = {}
+ROOM_STREAMS = {}
+
+def acquire_room_signal(room_code):
+    with ROOM_SIGNALS_LOCK:
+        if room_code not in ROOM_SIGNALS:
+            ROOM_SIGNALS[room_code] = threading.Condition()
+            ROOM_SEQ[room_code] = 0
+        ROOM_STREAMS[room_code] = ROOM_STREAMS.get(room_code, 0) + 1
+        return ROOM_SIGNALS[room_code]
+
+def release_room_signal(room_code):
+    with ROOM_SIGNALS_LOCK:
+        ROOM_STREAMS[room_code] -= 1
+        if not ROOM_STREAMS[room_code]:
+            del ROOM_STREAMS[room_code], ROOM_SIGNALS[room_code], ROOM_SEQ[room_code]
+
+def room_changed(room_code):
+    """Drops the cached GET response for a room and wakes its open streams, if any."""
+    MESSAGE_CACHE.pop(room_code, None)
+    # Bumped under the registry lock so a stream releasing the last hold cannot race the increment
+    with ROOM_SIGNALS_LOCK:
+        signal = ROOM_SIGNALS.get(room_code)
+        if signal is None: return
+        ROOM_SEQ[room_code] += 1
+    with signal: signal.notify_all()
+
+def all_rooms_changed():
+    MESSAGE_CACHE.clear()
+    for room_code in list(ROOM_SIGNALS): room_changed(room_code)
+
+def get_room_version(room_code):
+    """Cheap fingerprint of a room: changes on any insert or delete, including ones made by other instances."""
+    if room_code:
+        res = execute_query("SELECT MAX(id) AS last_id, COUNT(*) AS total FROM messages WHERE room_code = ?", (room_code,), fetch_one=True)
+    else:
+        res = execute_query("SELECT MAX(id) AS last_id, COUNT(*) AS total FROM messages WHERE room_code IS NULL", fetch_one=True)
+    return (res['last_id'], res['total']) if res else None
+
+def fetch_messages(room_code, since=0):
+    """
+    Returns the messages of a private room, or of the global room when room_code is None, oldest first.
+    With since > 0 only messages with a larger id are returned. None if the database read failed.
+    """
+    if since > 0:
+        if room_code:
+            messages = execute_query(SQL_SELECT_ROOM_MESSAGES_SINCE, (room_code, since), fetch_all=True)
+        else:
+            messages = execute_query(SQL_SELECT_GLOBAL_MESSAGES_SINCE, (since,), fetch_all=True)
+    else:
+        if room_code:
+            messages = execute_query(SQL_SELECT_ROOM_MESSAGES, (room_code,), fetch_all=True)
+        else:
+            messages = execute_query(SQL_SELECT_GLOBAL_MESSAGES, fetch_all=True)
+        if messages: messages.reverse()
+    if messages is None: return None
+
+    # ISO-8601 with an explicit offset for both backends, so the client can hand it straight to Date
+    for msg in messages:
+        ts = msg['timestamp']
+        if isinstance(ts, datetime):
+            if ts.tzinfo: ts = ts.astimezone(timezone.utc)
+            msg['timestamp'] = ts.strftime('%Y-%m-%dT%H:%M:%SZ')
+        elif ts:
+            # SQLite: "YYYY-MM-DD HH:MM:SS" is UTC; rows from older versions already end in an offset like +00:00
+            ts = ts.replace(' ', 'T')
+            msg['timestamp'] = ts if ts.endswith('Z') or '+' in ts[10:] or '-' in ts[10:] else ts + 'Z'
+    return messages
+
+def message_payload(room_code, since=0):
+    """
+    The /api/messages body: new messages, the room's total (so clients can spot deletions) and the node count.
+    None if the database could not be read; a made-up empty room would wipe every client's view.
+    """
+    version = get_room_version(room_code)
+    messages = fetch_messages(room_code, since) if version else None
+    if messages is None: return None
+    return {
+        "messages": messages,
+        "total": version[1],
+        "active_count": get_active_user_count()
+    }
+
+# --- Message Write Batching (Group Commit) ---
+MESSAGE_QUEUE = deque()
+MESSAGE_QUEUE_LOCK = threading.Lock()
+FLUSH_LOCK = threading.Lock()
+QUEUED_SEQ = 0
+FLUSHED_SEQ = 0
+FAILED_SEQS = set()  # seqs whose row was rejected; each sender collects (and removes) its own under FLUSH_LOCK
+
+def insert_messages(conn, db_type, rows):
+    """Writes rows in one transaction; returns False (rolled back) if any of them is rejected."""
     try:
+        cur = conn.cursor()
         if db_type == 'postgres':
-            cur = conn.cursor()
-            cur.execute("UPDATE active_users SET last_seen = %s WHERE username = %s", (now, username))
-            if cur.rowcount == 0:
-                cur.execute("INSERT INTO active_users (username, last_seen) VALUES (%s, %s) ON CONFLICT (username) DO UPDATE SET last_seen = %s", (username, now, now))
+            execute_values(cur, SQL_INSERT_MESSAGES_PG, rows, page_size=100)
         else:
-            cur = conn.cursor()
-            cur.execute("UPDATE active_users SET last_seen = ? WHERE username = ?", (now, username))
-            if cur.rowcount == 0:
-                cur.execute("INSERT OR REPLACE INTO active_users (username, last_seen) VALUES (?, ?)", (username, now))
+            # Take the write lock up front so the whole batch shares one transaction and one sync
+            if not conn.in_transaction: cur.execute("BEGIN IMMEDIATE")
+            cur.executemany(SQL_INSERT_MESSAGES_SQLITE, rows)
         conn.commit()
-    finally:
-        conn.close()
+        return True
+    except Exception as e:
+        print(f"Batch Insert Error: {e}")
+        rollback_quietly(conn)
+        return False
 
-def get_active_user_count():
-    """Count users active in last 30 seconds."""
-    thirty_sec_ago = datetime.now(timezone.utc) - timedelta(seconds=30)
-    res = execute_query("SELECT COUNT(*) as count FROM active_users WHERE last_seen > ?", (thirty_sec_ago,), fetch_one=True)
-    return res['count'] if res else 0
+def flush_messages():
+    """Writes every queued message with a single batched INSERT. Caller must hold FLUSH_LOCK."""
+    global FLUSHED_SEQ
+    with MESSAGE_QUEUE_LOCK:
+        batch = list(MESSAGE_QUEUE)
+        MESSAGE_QUEUE.clear()
+        last_seq = QUEUED_SEQ
+    if batch:
+        with db_connection() as (conn, db_type):
+            if not insert_messages(conn, db_type, [row for _, row in batch]):
+                # One bad row must not sink everyone else's: retry singly so only it fails
+                for seq, row in batch:
+                    if not insert_messages(conn, db_type, [row]): FAILED_SEQS.add(seq)
+        for room_code in {row[2] for seq, row in batch if seq not in FAILED_SEQS}: room_changed(room_code)
+    FLUSHED_SEQ = last_seq
+
+def save_message(username, content, room_code):
+    """
+    Queues a message and returns True once it has been written, False if the database rejected it.
+    Senders that arrive while a flush is running are written together by the next flush.
+    """
+    global QUEUED_SEQ
+    with MESSAGE_QUEUE_LOCK:
+        QUEUED_SEQ += 1
+        seq = QUEUED_SEQ
+        MESSAGE_QUEUE.append((seq, (username, content, room_code)))
+    with FLUSH_LOCK:
+        if FLUSHED_SEQ < seq:
+            flush_messages()
+        if seq in FAILED_SEQS:
+            FAILED_SEQS.discard(seq)
+            return False
+    return True
 
 # Initialize DB on load
 init_db()
+# init_db ran at import, possibly before a server forks workers; they must not share its pooled sockets
+close_pg_pool()
 
 # --- Frontend Template ---
 HTML_TEMPLATE = """
@@ -291,7 +707,7 @@ HTML_TEMPLATE = """
 
         <div class="bg-black p-4 border-t border-white">
             <form id="chat-form" class="flex space-x-2">
-                <input type="text" id="msg-input" placeholder="ENTER MESSAGE..." required autocomplete="off"
+                <input type="text" id="msg-input" placeholder="ENTER MESSAGE..." required autocomplete="off" maxlength="2000"
                     class="flex-1 bg-black border border-gray-600 text-white p-3 rounded-none focus:border-white focus:ring-0 outline-none font-mono">
                 <button type="submit" class="bg-white hover:bg-gray-200 text-black px-6 py-2 rounded-none font-bold uppercase tracking-widest transition">SEND</button>
             </form>
@@ -309,65 +725,94 @@ HTML_TEMPLATE = """
 
         function scrollToBottom() { container.scrollTop = container.scrollHeight; }
 
-        function escapeHtml(text) {
-            if (!text) return text;
-            return text
-                .replace(/&/g, "&amp;")
-                .replace(/</g, "&lt;")
-                .replace(/>/g, "&gt;")
-                .replace(/"/g, "&quot;")
-                .replace(/'/g, "&#039;");
-        }
-
         async function deleteMessage(id) {
             if(!confirm("DELETE TRANSMISSION PERMANENTLY?")) return;
             try {
                 const res = await fetch(`/api/messages/${id}`, { method: 'DELETE' });
-                if(res.ok) fetchMessages();
+                if(res.ok) {
+                    const node = document.getElementById(`msg-${id}`);
+                    if (node) { node.remove(); knownTotal -= 1; }
+                    fetchMessages();
+                }
             } catch(e) { console.error(e); }
         }
 
+        function el(tag, className, text) {
+            const node = document.createElement(tag);
+            node.className = className;
+            if (text !== undefined) node.textContent = text;
+            return node;
+        }
+
+        // Built with the DOM API: user text only ever lands in textContent, so it is never parsed as HTML
+        function buildBubble(msg) {
+            const isMe = msg.username === currentUser;
+            // The server sends ISO-8601 with an explicit offset ("YYYY-MM-DDTHH:MM:SSZ" for new rows)
+            const dateObj = new Date(msg.timestamp);
+            const timeStr = dateObj.toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
+
+            const bubble = el('div', `flex flex-col ${isMe ? 'items-end' : 'items-start'} msg-bubble group`);
+            bubble.id = `msg-${msg.id}`;
+
+            const meta = el('div', 'text-[12px] text-gray-500 mb-1 px-1 font-mono uppercase flex items-center');
+            meta.append(isMe ? 'YOU' : msg.username, el('span', 'text-gray-700 mx-1', '|'), timeStr);
+            if (isMe) {
+                const del = el('button', 'ml-2 text-red-500 hover:text-red-300 text-[12px] border border-red-900 px-1 hover:border-red-500 transition uppercase', '[DEL]');
+                del.addEventListener('click', () => deleteMessage(msg.id));
+                meta.append(del);
+            }
+
+            bubble.append(meta, el('div', `${isMe ? 'bg-white text-black border border-white' : 'bg-black text-white border border-white'} max-w-[80%] px-4 py-2 rounded-none shadow-none text-sm break-words font-mono`, msg.content));
+            return bubble;
+        }
+
+        // Incremental sync: only messages newer than lastId are fetched and appended.
+        // knownTotal tracks the room's message count; when the server's count disagrees
+        // (deletes, expiry, or a gap) the view is rebuilt from scratch.
+        let lastId = 0;
+        let knownTotal = 0;
+        let fetching = false;
+        let fetchAgain = false;
+
+        // Applies one /api/messages payload; returns false when messages were deleted and a full resync is needed
+        function applyMessages(data) {
+            const messages = data.messages.filter(msg => msg.id > lastId);
+
+            if (data.active_count !== undefined && nodeCount) nodeCount.textContent = data.active_count;
+
+            if (lastId && knownTotal + messages.length !== data.total) {
+                lastId = 0;
+                return false;
+            }
+            if (!lastId) container.innerHTML = '';
+            knownTotal = data.total;
+
+            if (messages.length) {
+                const frag = document.createDocumentFragment();
+                for (const msg of messages) frag.appendChild(buildBubble(msg));
+                const empty = document.getElementById('empty-state');
+                if (empty) empty.remove();
+                container.appendChild(frag);
+                lastId = messages[messages.length - 1].id;
+                scrollToBottom();
+            } else if (!container.children.length) {
+                container.innerHTML = '<div id="empty-state" class="text-center py-10 text-gray-600 text-xs font-mono uppercase tracking-widest">Signal Silence.</div>';
+            }
+            return true;
+        }
+
         async function fetchMessages() {
+            if (fetching) { fetchAgain = true; return; }
+            fetching = true;
             try {
-                const response = await fetch('/api/messages');
-                if (response.status === 429) return; 
-                const data = await response.json();
-                const messages = data.messages;
-                
-                if (data.active_count !== undefined && nodeCount) nodeCount.textContent = data.active_count;
-                
-                const currentContent = messages.map(msg => msg.id).join(',');
-                if (container.dataset.hash !== currentContent) {
-                    container.dataset.hash = currentContent;
-                    if(messages.length === 0) {
-                        container.innerHTML = '<div class="text-center py-10 text-gray-600 text-xs font-mono uppercase tracking-widest">Signal Silence.</div>';
-                        return;
-                    }
-                    container.innerHTML = messages.map(msg => {
-                        const isMe = msg.username === currentUser;
-                        // Handle time: append Z if missing to assume UTC
-                        let ts = msg.timestamp;
-                        if (!ts.endsWith('Z') && !ts.includes('+')) ts += 'Z';
-                        
-                        const dateObj = new Date(ts);
-                        const timeStr = dateObj.toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
-                        
-                        const deleteBtn = isMe ? `<button onclick="deleteMessage(${msg.id})" class="ml-2 text-red-500 hover:text-red-300 text-[12px] border border-red-900 px-1 hover:border-red-500 transition uppercase">[DEL]</button>` : '';
-
-                        return `
-                            <div class="flex flex-col ${isMe ? 'items-end' : 'items-start'} msg-bubble group">
-                                <div class="text-[12px] text-gray-500 mb-1 px-1 font-mono uppercase flex items-center">
-                                    ${isMe ? 'YOU' : escapeHtml(msg.username)} <span class="text-gray-700 mx-1">|</span> ${timeStr} ${deleteBtn}
-                                </div>
-                                <div class="${isMe ? 'bg-white text-black border border-white' : 'bg-black text-white border border-white'} max-w-[80%] px-4 py-2 rounded-none shadow-none text-sm break-words font-mono">
-                                    ${escapeHtml(msg.content)}
-                                </div>
-                            </div>
-                        `;
-                    }).join('');
-                    scrollToBottom();
-                }
+                const response = await fetch(`/api/messages?since=${lastId}`);
+                if (!response.ok) return;  // rate limited or the database hiccuped; the next poll retries
+                if (!applyMessages(await response.json())) fetchAgain = true;
             } catch (e) { console.error("Connection lost...", e); }
+            finally {
+                fetching = false;
+                if (fetchAgain) { fetchAgain = false; fetchMessages(); }
+            }
         }
 
         form.addEventListener('submit', async (e) => {
@@ -387,17 +832,31 @@ HTML_TEMPLATE = """
                 statusMsg.textContent = "SLOW DOWN // TRANSMISSION RATE EXCEEDED";
                 statusMsg.classList.add('text-red-500', 'shake');
                 setTimeout(() => statusMsg.classList.remove('shake'), 500);
+            } else if (!res.ok) {
+                statusMsg.textContent = "TRANSMISSION FAILED // MESSAGE NOT SENT";
+                statusMsg.classList.add('text-red-500');
             }
             fetchMessages(); 
         });
-        setInterval(fetchMessages, 2000);
-        fetchMessages();
+        // The first payload is rendered into the page, so the chat paints without a fetch round-trip
+        applyMessages({{ initial_messages|tojson }});
+
+        // Server pushes a 'messages' event on every change; the slow poll is only a presence heartbeat / fallback.
+        // The stream is told what the page already shows, so it only signals changes made after render;
+        // reconnects send the id of the last 'messages' event instead, so they skip the ones already signalled.
+        const stream = new EventSource(`/api/stream?last=${lastId}&total=${knownTotal}`);
+        stream.addEventListener('messages', fetchMessages);
+        stream.addEventListener('presence', (ev) => { if (nodeCount) nodeCount.textContent = ev.data; });
+        setInterval(fetchMessages, 15000);
     </script>
     {% endif %}
 </body>
 </html>
 """
 
+# Compiled once at import; render_template_string() would re-parse the source on every hit
+HTML_PAGE = app.jinja_env.from_string(HTML_TEMPLATE)
+
 # --- Admin Frontend Template ---
 ADMIN_TEMPLATE = """
 <!DOCTYPE html>
@@ -550,25 +1009,53 @@ ADMIN_TEMPLATE = """
 </html>
 """
 
+ADMIN_PAGE = app.jinja_env.from_string(ADMIN_TEMPLATE)
+
+# --- Response Compression ---
+COMPRESS_MIN_SIZE = 500
+COMPRESS_LEVEL = 5   # chat payloads are small; 5 is within a few percent of 6's ratio for less CPU
+COMPRESS_MIMETYPES = {'text/html', 'application/json'}
+
+@app.after_request
+def compress_response(response):
+    """Gzips rendered pages and API payloads for clients that accept it."""
+    if (response.mimetype not in COMPRESS_MIMETYPES or response.status_code != 200 or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.headers.get('Accept-Encoding', '')):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE: return response
+    response.set_data(gzip.compress(data, COMPRESS_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    # A strong ETag names exact bytes; the gzipped body is a different representation
+    etag, weak = response.get_etag()
+    if etag and not weak: response.set_etag(etag, weak=True)
+    response.vary.add('Accept-Encoding')
+    return response
+
 # --- Routes ---
 
 @app.route('/')
 def home():
-    if 'username' in session and 'room_type' in session:
-        return render_template_string(HTML_TEMPLATE)
-    if 'username' in session:
-        return render_template_string(HTML_TEMPLATE)
-    return render_template_string(HTML_TEMPLATE)
+    # One template covers the login, lobby and chat views; it branches on the session itself
+    initial_messages = None
+    if session.get('username') and session.get('room_type'):
+        # A failed read still renders the chat; the empty view differs from the room, so the stream triggers a fetch
+        initial_messages = message_payload(session.get('room_code')) or {"messages": [], "total": 0}
+    resp = app.make_response(render_template(HTML_PAGE, initial_messages=initial_messages))
+    # The page only changes with the session, so repeat loads revalidate to an empty 304
+    resp.add_etag()
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp.make_conditional(request)
 
 @app.route('/login', methods=['POST'])
 def login():
-    cleanup_data() # Opportunistic cleanup
+    maybe_cleanup_data() # Opportunistic cleanup
     username = request.form.get('username')
     if not username: return redirect(url_for('home'))
 
     # Check for unique username (if active in last 2 minutes)
-    two_mins_ago = datetime.now(timezone.utc) - timedelta(minutes=2)
-    exists = execute_query("SELECT 1 FROM active_users WHERE username = ? AND last_seen > ?", (username, two_mins_ago), fetch_one=True)
+    exists = execute_query(f"SELECT 1 FROM active_users WHERE username = ? AND last_seen > {sql_ago(120)}", (username,), fetch_one=True)
     
     if exists:
         flash("IDENTITY ALREADY ACTIVE. CHOOSE ANOTHER.")
@@ -595,18 +1082,21 @@ def join_global():
     session.pop('room_name', None)
     return redirect(url_for('home'))
 
+ROOM_CODE_ATTEMPTS = 10
+
 @app.route('/create_room', methods=['POST'])
 def create_room():
     room_name = request.form.get('room_name')
     if not room_name: return redirect(url_for('home'))
         
-    while True:
-        code = ''.join(random.choices(string.ascii_uppercase, k=4))
-        exists = execute_query('SELECT 1 FROM rooms WHERE code = ?', (code,), fetch_one=True)
-        if not exists:
-            execute_query('INSERT INTO rooms (code, name) VALUES (?, ?)', (code, room_name))
-            break
-    
+    # The primary key arbitrates collisions: one write per attempt and no check-then-insert race
+    for _ in range(ROOM_CODE_ATTEMPTS):
+        code = ''.join(secrets.choice(string.ascii_uppercase) for _ in range(4))
+        if execute_query('INSERT INTO rooms (code, name) VALUES (?, ?) ON CONFLICT (code) DO NOTHING', (code, room_name)): break
+    else:
+        flash("ROOM ALLOCATION FAILED // TRY AGAIN")
+        return redirect(url_for('home'))
+
     session['room_type'] = 'private'
     session['room_code'] = code
     session['room_name'] = room_name
@@ -622,7 +1112,7 @@ def join_room():
         flash("SECURITY LOCKOUT // TOO MANY FAILED ATTEMPTS")
         return redirect(url_for('home'))
     
-    room = execute_query('SELECT * FROM rooms WHERE code = ?', (code,), fetch_one=True)
+    room = execute_query('SELECT code, name FROM rooms WHERE code = ?', (code,), fetch_one=True)
     
     if room:
         session['room_type'] = 'private'
@@ -646,13 +1136,14 @@ def delete_message(msg_id):
     
     # Only allow deleting own messages
     execute_query("DELETE FROM messages WHERE id = ? AND username = ?", (msg_id, session['username']))
+    room_changed(session.get('room_code'))
     return jsonify({"status": "deleted"})
 
 @app.route('/api/messages', methods=['GET', 'POST'])
 def api_messages():
-    cleanup_data()
     if 'username' not in session: return jsonify({"error": "Unauthorized"}), 401
-    
+    maybe_cleanup_data()
+
     room_code = session.get('room_code')
     update_user_presence(session['username'])
     
@@ -661,39 +1152,106 @@ def api_messages():
             return jsonify({"error": "Rate limit exceeded"}), 429
 
         content = request.get_json().get('content')
-        if content:
-            execute_query(
-                'INSERT INTO messages (username, content, room_code, timestamp) VALUES (?, ?, ?, ?)',
-                (session['username'], content, room_code, datetime.now(timezone.utc))
-            )
+        # Postgres rejects NUL in text, and it is valid JSON ("\u0000"), so drop it before it reaches a batch
+        if isinstance(content, str): content = content.replace('\x00', '')
+        if isinstance(content, str) and content:
+            if not save_message(session['username'], content[:MAX_MESSAGE_LENGTH], room_code):
+                return jsonify({"error": "Message could not be saved"}), 500
             return jsonify({"status": "sent"})
 
-    # GET
-    if room_code:
-        messages = execute_query('SELECT * FROM messages WHERE room_code = ? ORDER BY timestamp ASC', (room_code,), fetch_all=True)
+    # GET ?since=<id> returns only newer messages plus the room's total, so clients can spot deletions.
+    # Served from the per-room cache while it is fresh; pollers in a room mostly share the same since.
+    # Ids are 64-bit on both backends; anything outside that range would overflow the query parameter
+    since = min(max(request.args.get('since', 0, type=int), 0), MAX_MESSAGE_ID)
+    room_cache = MESSAGE_CACHE.setdefault(room_code, {})
+    cached = room_cache.get(since)
+    if cached and time.monotonic() - cached[0] < MESSAGE_CACHE_TTL:
+        body, etag, gz_body = cached[1:]
     else:
-        messages = execute_query('SELECT * FROM messages WHERE room_code IS NULL ORDER BY timestamp ASC', fetch_all=True)
-    
-    # Convert datetime objects to string for JSON serialization
-    for msg in messages:
-        if isinstance(msg['timestamp'], datetime):
-            msg['timestamp'] = msg['timestamp'].isoformat()
+        # Encode once straight to bytes; cache hits send these bytes as-is
+        payload = message_payload(room_code, since)
+        if payload is None: return jsonify({"error": "Database unavailable"}), 503
+        body = app.json.dumps_bytes(payload) if orjson else app.json.dumps(payload).encode()
+        etag = generate_etag(body)
+        # Compressed once per cache entry, so a room's worth of clients fetching together share one gzip
+        gz_body = gzip.compress(body, COMPRESS_LEVEL) if len(body) >= COMPRESS_MIN_SIZE else None
+        now = time.monotonic()
+        # Drop expired entries on every store so an idle room cannot accumulate one per distinct since
+        for key, entry in list(room_cache.items()):
+            if now - entry[0] >= MESSAGE_CACHE_TTL: room_cache.pop(key, None)
+        if len(room_cache) < MESSAGE_CACHE_MAX_KEYS: room_cache[since] = (now, body, etag, gz_body)
 
-    return jsonify({
-        "messages": messages,
-        "active_count": get_active_user_count()
-    })
+    if gz_body and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        resp = app.response_class(gz_body, mimetype='application/json')
+        resp.headers['Content-Encoding'] = 'gzip'
+        resp.set_etag(etag, weak=True)
+    else:
+        resp = app.response_class(body, mimetype='application/json')
+        resp.set_etag(etag)
+    if gz_body: resp.vary.add('Accept-Encoding')
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp.make_conditional(request)
+
+# --- Push Channel (Server-Sent Events) ---
+STREAM_DURATION = 25        # seconds before the server ends a stream; EventSource reconnects on its own
+STREAM_CHECK_INTERVAL = 5   # seconds between DB checks, catching writes made by other instances
+
+@app.route('/api/stream')
+def api_stream():
+    """Pushes a 'messages' event whenever the room changes and a 'presence' event with the node count."""
+    if 'username' not in session: return jsonify({"error": "Unauthorized"}), 401
+    username = session['username']
+    room_code = session.get('room_code')
+    # The page reports the (last id, total) it rendered, so a fresh stream skips the redundant first event.
+    # EventSource reconnects to that same URL, so after a change the id of the last event it got is newer.
+    last_event = request.headers.get('Last-Event-ID')
+    if last_event:
+        last, _, total = last_event.partition('-')
+        seen_version = (int(last) or None, int(total)) if last.isdigit() and total.isdigit() else None
+    else:
+        total = request.args.get('total', type=int)
+        seen_version = (request.args.get('last', 0, type=int) or None, total) if total is not None else None
+
+    def generate():
+        deadline = time.monotonic() + STREAM_DURATION
+        signal = acquire_room_signal(room_code)
+        version = seen_version
+        try:
+            yield "retry: 1000\n\n"
+            while True:
+                # Comment line as heartbeat: a closed connection fails here, before anything touches the DB
+                yield ": ping\n\n"
+                with signal: seen = ROOM_SEQ.get(room_code, 0)
+                touch_user_presence(username)
+                current = get_room_version(room_code)
+                if current != version:
+                    version = current
+                    # Becomes the stream's Last-Event-ID, so a reconnect resumes from this version
+                    event_id = f"id: {current[0] or 0}-{current[1]}\n" if current else ""
+                    yield f"{event_id}event: messages\ndata: changed\n\n"
+                yield f"event: presence\ndata: {get_active_user_count()}\n\n"
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                with signal:
+                    if ROOM_SEQ.get(room_code, 0) == seen:
+                        signal.wait(min(STREAM_CHECK_INTERVAL, remaining))
+        finally:
+            release_room_signal(room_code)
+
+    return app.response_class(generate(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/admin')
 def admin_dashboard():
     if not session.get('admin_logged_in'):
-        return render_template_string(ADMIN_TEMPLATE)
+        return render_template(ADMIN_PAGE)
     
     # Fetch stats
     stats = {}
     
     # Active users
-    users = execute_query("SELECT * FROM active_users ORDER BY last_seen DESC", fetch_all=True)
+    users = execute_query("SELECT username, last_seen FROM active_users ORDER BY last_seen DESC", fetch_all=True)
     stats['user_count'] = len(users) if users else 0
     
     # Private Rooms
@@ -713,7 +1271,7 @@ def admin_dashboard():
     else:
         stats['message_count'] = 0
         
-    return render_template_string(ADMIN_TEMPLATE, stats=stats, rooms=rooms, users=users)
+    return render_template(ADMIN_PAGE, stats=stats, rooms=rooms, users=users)
 
 @app.route('/admin/login', methods=['POST'])
 def admin_login():
@@ -747,6 +1305,7 @@ def admin_deactivate_room(code):
     
     execute_query("DELETE FROM messages WHERE room_code = ?", (code,))
     execute_query("DELETE FROM rooms WHERE code = ?", (code,))
+    room_changed(code)
     flash(f"ROOM {code} DEACTIVATED")
     return redirect(url_for('admin_dashboard'))
 